@@ -26,7 +26,10 @@ def main():
     ap.add_argument("--proxy", default=None, help="HTTP/HTTPS proxy, e.g. http://host:port")
     ap.add_argument("--debug", "-v", action="store_true", help="Enable verbose HTTP request/response logs and extra diagnostics")
     ap.add_argument("--throttle", type=float, default=2.0, help="Seconds delay between episode requests (default: 2.0)")
+    ap.add_argument("--workers", "-w", type=int, default=3, help="Episodes fetched concurrently (default: 3)")
     ap.add_argument("--txt", "-txt", action="store_true", help="Output plain .txt files per episode instead of EPUB")
+    ap.add_argument("--no-cache", dest="no_cache", action="store_true", help="Do not read or write the per-book episode cache")
+    ap.add_argument("--refresh", action="store_true", help="Re-download every episode and overwrite the cache")
     args = ap.parse_args()
 
     const.HTTP_LOG = bool(args.debug)
@@ -41,7 +44,7 @@ def main():
     password = args.password or os.getenv("NOVELPIA_PASSWORD")
 
     if email and password:
-        client = NovelpiaClient(email=email, password=password, proxy=args.proxy, throttle=args.throttle, userkey=cfg_userkey, tkey=cfg_tkey)
+        client = NovelpiaClient(email=email, password=password, proxy=args.proxy, throttle=args.throttle, userkey=cfg_userkey, tkey=cfg_tkey, concurrency=args.workers)
         client.login()
         # Persist/refresh tokens after successful login
         userkey_val = None
@@ -61,7 +64,7 @@ def main():
             "tkey": tkey_val or client.tokens.tkey or cfg_tkey or "",
         })
     elif cfg_login_at and cfg_userkey:
-        client = NovelpiaClient(email=None, password=None, proxy=args.proxy, throttle=args.throttle, userkey=cfg_userkey, tkey=cfg_tkey)
+        client = NovelpiaClient(email=None, password=None, proxy=args.proxy, throttle=args.throttle, userkey=cfg_userkey, tkey=cfg_tkey, concurrency=args.workers)
         client.tokens.login_at = cfg_login_at
     else:
         print("[error] No credentials or stored tokens found. Provide --user and --pass to login once.")
@@ -75,6 +78,7 @@ def main():
                 end_chapter=args.end_chapter,
                 max_chapters=(args.max_chapters if args.max_chapters and args.max_chapters > 0 else None),
                 language=args.lang, debug_dump=args.debug,
+                use_cache=not args.no_cache, refresh_cache=args.refresh,
             )
             print(f"\n[success] Wrote TXT files under: {out_dir_final}")
         else:
@@ -83,7 +87,8 @@ def main():
                 start_chapter=args.start_chapter,
                 end_chapter=args.end_chapter,
                 max_chapters=(args.max_chapters if args.max_chapters and args.max_chapters > 0 else None),
-                language=args.lang, debug_dump=args.debug
+                language=args.lang, debug_dump=args.debug,
+                use_cache=not args.no_cache, refresh_cache=args.refresh,
             )
             print(f"\n[success] Wrote EPUB: {out_file}")
     except Exception as e:
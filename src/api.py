@@ -1,18 +1,43 @@
-import json
-import os
 import random
 import time
 import uuid
 import requests
 import concurrent.futures
-import re as _re
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import re
 
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional
 from src import const
-from src.helper import j, mask_kv, attach_auth_cookies, merge_login_at
-from src.helper import extract_t_token
-from src.novel import html_from_episode_text
+from src.helper import j, mask_kv, merge_login_at
+from src.helper import extract_t_token, json_of, load_config, save_config, RateLimiter
+
+_TRAILING_NUM_RE = re.compile(r"(\d+)$")
+
+def _epi_content_key(k: str):
+    m = _TRAILING_NUM_RE.search(k)
+    return (0 if k == "epi_content" else 1, int(m.group(1)) if m else 0)
+
+def _join_epi_content(data_block: Dict) -> str:
+    """Concatenate epi_content, epi_content2, epi_content3, ... in order."""
+    parts = []
+    k, i, walked = "epi_content", 1, 0
+    while k in data_block:
+        walked += 1
+        v = data_block[k]
+        if isinstance(v, str) and v:
+            parts.append(v)
+        i += 1
+        k = f"epi_content{i}"
+    # numbering with gaps (or an epi_content1) falls back to sorting every key
+    if walked != sum(1 for kk in data_block if str(kk).startswith("epi_content")):
+        parts = []
+        for k in sorted([kk for kk in data_block.keys() if str(kk).startswith("epi_content")], key=_epi_content_key):
+            v = data_block.get(k)
+            if isinstance(v, str) and v:
+                parts.append(v)
+    return "".join(parts)
 
 # ----------------------------
 # API Client
@@ -27,9 +52,29 @@ class Tokens:
 class NovelpiaClient:
     def __init__(self, email: Optional[str] = None, password: Optional[str] = None,
                  proxy: Optional[str] = None, timeout: int = 30, throttle: float = 1.5,
-                 userkey: Optional[str] = None, tkey: Optional[str] = None):
+                 userkey: Optional[str] = None, tkey: Optional[str] = None,
+                 concurrency: int = 3):
         self.s = requests.Session()
         self.s.headers.update(const.SESSION_HEADERS.copy())
+        self.s.headers["Connection"] = "keep-alive"
+        # number of episodes fetched in flight; the shared limiter allows one call
+        # per --throttle for each worker, up to MAX_THROTTLED_WORKERS, so larger
+        # values only overlap request latency
+        self.concurrency = max(1, int(concurrency or 1))
+        # one pool per host with a warm connection for every in-flight request;
+        # network errors and 5xx are retried at the pool level, 429 and expired
+        # tokens are handled by request_with_retries
+        pool_size = max(const.HTTP_POOL_SIZE, self.concurrency + const.IMAGE_WORKERS)
+        retry = Retry(
+            total=3, backoff_factor=1.25,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),
+            # 429 must reach request_with_retries so the shared throttle backs off
+            respect_retry_after_header=False, raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=const.HTTP_POOL_SIZE, pool_maxsize=pool_size, max_retries=retry)
+        self.s.mount("https://", adapter)
+        self.s.mount("http://", adapter)
         if proxy:
             self.s.proxies.update({"http": proxy, "https": proxy})
         self.timeout = timeout
@@ -38,6 +83,7 @@ class NovelpiaClient:
         self.password = password
         # delay seconds between episode-related API calls to reduce 429/500 rate limits
         self.throttle = max(0.0, float(throttle or 1.5))
+        self.limiter = RateLimiter(self._throttle_interval)
         try:
             if not userkey:
                 userkey = uuid.uuid4().hex
@@ -57,7 +103,7 @@ class NovelpiaClient:
             timeout=self.timeout, max_retries=2,
         )
         r.raise_for_status()
-        data = r.json()
+        data = json_of(r)
         self.tokens.login_at = data["result"]["LOGINAT"]
         # Capture cookies after successful login
         try:
@@ -77,26 +123,18 @@ class NovelpiaClient:
             timeout=self.timeout, max_retries=2,
         )
         r.raise_for_status()
-        self.tokens.login_at = r.json()["result"]["LOGINAT"]
+        self.tokens.login_at = json_of(r)["result"]["LOGINAT"]
         # Persist refreshed token to config
-        try:
-            cfg: Dict[str, Any] = {}
-            if os.path.exists(const.CONFIG_PATH):
-                try:
-                    with open(const.CONFIG_PATH, "r", encoding="utf-8") as f:
-                        cfg = json.load(f) or {}
-                except Exception as e:
-                    print(f"Error loading config: {e}")
-                    cfg = {}
-            cfg["login_at"] = self.tokens.login_at
-            with open(const.CONFIG_PATH, "w", encoding="utf-8") as f:
-                json.dump(cfg, f, ensure_ascii=False, indent=2)
-                pass
-        except Exception as e:
-            print(f"Error saving config: {e}")
-            pass
+        cfg = load_config(use_env=False)
+        cfg["login_at"] = self.tokens.login_at
+        save_config(cfg)
         return self.tokens.login_at
 
+    def _throttle_interval(self) -> float:
+        if not self.throttle:
+            return 0.0
+        return (self.throttle + random.uniform(1.0, 1.5)) / min(self.concurrency, const.MAX_THROTTLED_WORKERS)
+
     def _on_rate_limit(self):
         """Increase throttle when 429 occurs."""
         old = self.throttle
@@ -104,78 +142,48 @@ class NovelpiaClient:
         if const.HTTP_LOG:
             print(f"[api] Increased throttle from {old}s to {self.throttle}s due to rate limit.")
 
-    def me(self) -> Dict:
-        url = f"{const.API_BASE}/v1/login/me"
+    def _get_json(self, url: str, params: Optional[Dict] = None, login_at: bool = True, **kwargs) -> Dict:
+        """Authenticated GET with token refresh/re-login and 429 backoff, decoded as JSON."""
         r = request_with_retries(
             self.s, "GET", url,
-            headers=merge_login_at({}, self.tokens.login_at),
-            timeout=self.timeout, allow_refresh=True, 
+            headers=merge_login_at({}, self.tokens.login_at) if login_at else None,
+            params=params, timeout=self.timeout, allow_refresh=True,
             refresh_fn=self.refresh, login_fn=self.login,
-            on_rate_limit=self._on_rate_limit
+            on_rate_limit=self._on_rate_limit, **kwargs,
         )
         r.raise_for_status()
-        return r.json()
+        return json_of(r)
+
+    def me(self) -> Dict:
+        return self._get_json(f"{const.API_BASE}/v1/login/me")
 
     def novel(self, novel_id: int) -> Dict:
-        url = f"{const.API_BASE}/v1/novel"
-        r = request_with_retries(
-            self.s, "GET", url,
-            headers=merge_login_at({}, self.tokens.login_at),
-            params={"novel_no": novel_id},
-            timeout=self.timeout, allow_refresh=True, 
-            refresh_fn=self.refresh, login_fn=self.login,
-            on_rate_limit=self._on_rate_limit
-        )
-        r.raise_for_status()
-        return r.json()
+        return self._get_json(f"{const.API_BASE}/v1/novel", params={"novel_no": novel_id})
 
     def episode_list(self, novel_id: int, rows: int) -> Dict:
-        url = f"{const.API_BASE}/v1/novel/episode/list"
-        r = request_with_retries(
-            self.s, "GET", url,
-            headers=merge_login_at({}, self.tokens.login_at),
+        return self._get_json(
+            f"{const.API_BASE}/v1/novel/episode/list",
             params={"novel_no": novel_id, "rows": rows, "sort": "ASC"},
-            timeout=self.timeout, allow_refresh=True, 
-            refresh_fn=self.refresh, login_fn=self.login,
-            on_rate_limit=self._on_rate_limit
         )
-        r.raise_for_status()
-        return r.json()
 
     def episode_ticket(self, episode_no: int) -> Dict:
-        url = f"{const.API_BASE}/v1/novel/episode"
-        headers = merge_login_at({}, self.tokens.login_at)
-        params = {"episode_no": episode_no}
         # Throttle before hitting ticket endpoint to avoid rate limits
-        if self.throttle:
-            time.sleep(self.throttle + random.uniform(1.0, 1.5))
-        r = request_with_retries(
-            self.s, "GET", url,
-            headers=headers, params=params,
-            timeout=self.timeout, allow_refresh=True, 
-            refresh_fn=self.refresh, login_fn=self.login,
-            on_rate_limit=self._on_rate_limit, max_retries=4,
+        self.limiter.acquire()
+        return self._get_json(
+            f"{const.API_BASE}/v1/novel/episode",
+            params={"episode_no": episode_no}, max_retries=4,
         )
-        r.raise_for_status()
-        return r.json()
 
     def episode_content(self, token_t: str) -> Dict:
-        url = f"{const.API_BASE}/v1/novel/episode/content"
         # Throttle content fetch too, to be safe
-        if self.throttle:
-            time.sleep(self.throttle + random.uniform(1.0, 1.5))
-        r = request_with_retries(
-            self.s, "GET", url,
-            params={"_t": token_t},
-            timeout=self.timeout, max_retries=3,
-            allow_refresh=True, refresh_fn=self.refresh, login_fn=self.login,
-            on_rate_limit=self._on_rate_limit
+        self.limiter.acquire()
+        return self._get_json(
+            f"{const.API_BASE}/v1/novel/episode/content",
+            params={"_t": token_t}, login_at=False, max_retries=3,
         )
-        r.raise_for_status()
-        return r.json()
 
-    def fetch_episode(self, ep: Dict, idx: int = 0) -> Dict:
-        """Fetch ticket and content for a single episode."""
+    def fetch_episode(self, ep: Dict, idx: int = 0, cache=None) -> Dict:
+        """Fetch ticket and content for a single episode, served from cache when present."""
         episode_no = ep.get("episode_no")
         if episode_no is None:
             return {
@@ -186,7 +194,12 @@ class NovelpiaClient:
             }
         epi_no = int(episode_no)
         epi_title = ep.get("epi_title") or f"Episode {ep.get('epi_num')}"
-        
+
+        if cache is not None:
+            cached = cache.get(epi_no)
+            if cached is not None:
+                return {"html": cached, "epi_title": epi_title, "epi_no": epi_no, "idx": idx}
+
         # 1) Ticket
         try:
             tdata = self.episode_ticket(epi_no)
@@ -205,7 +218,7 @@ class NovelpiaClient:
                 assert direct_url is not None, "direct_url unavailable"
                 r = self.s.get(direct_url, timeout=self.timeout)
                 r.raise_for_status()
-                cdata = r.json()
+                cdata = json_of(r)
         except Exception as e:
             return {"error": str(e), "epi_no": epi_no, "epi_title": epi_title, "idx": idx}
 
@@ -213,19 +226,10 @@ class NovelpiaClient:
         result_block = cdata.get("result", {})
         data_block = result_block.get("data", {}) if isinstance(result_block, dict) else {}
 
-        parts = []
         try:
-            def _key(k: str):
-                m = _re.search(r"(\d+)$", k)
-                return (0 if k == "epi_content" else 1, int(m.group(1)) if m else 0)
-            for k in sorted([kk for kk in data_block.keys() if str(kk).startswith("epi_content")], key=_key):
-                v = data_block.get(k)
-                if isinstance(v, str) and v:
-                    parts.append(v)
+            html_text = _join_epi_content(data_block).strip()
         except Exception:
-            pass
-
-        html_text = "".join(parts).strip()
+            html_text = ""
         if not html_text:
             html_text = (
                 result_block.get("content")
@@ -235,19 +239,36 @@ class NovelpiaClient:
                 or ""
             )
 
+        if cache is not None and html_text:
+            try:
+                cache.put(epi_no, html_text)
+            except OSError as e:
+                print(f"[warn] Could not cache episode {epi_no}: {e}")
+
         return {
-            "html": html_from_episode_text(html_text),
+            "html": html_text,
             "epi_title": epi_title,
             "epi_no": epi_no,
             "idx": idx,
         }
 
-    def fetch_episodes_parallel(self, ep_list: List[Dict[str, Any]], max_workers: int = 3, progress_cb=None) -> List[Dict[str, Any]]:
-        """Fetch multiple episodes in parallel."""
+    def fetch_episodes_parallel(self, ep_list: List[Dict[str, Any]], max_workers: Optional[int] = None, progress_cb=None, result_cb=None, cache=None, worker_cb=None) -> List[Dict[str, Any]]:
+        """Fetch multiple episodes in parallel, results in ep_list order.
+        result_cb(idx, result) is invoked on the calling thread as each episode completes.
+        worker_cb(result) is invoked on the worker thread for each successful fetch, so
+        per-episode CPU work overlaps the other requests; if it raises, the episode fails.
+        cache, if given, is an EpisodeCache consulted before any request is made.
+        """
+        def fetch(ep: Dict, idx: int) -> Dict:
+            res = self.fetch_episode(ep, idx, cache)
+            if worker_cb and res and "error" not in res:
+                worker_cb(res)
+            return res
+
         results: List[Dict[str, Any]] = [{} for _ in range(len(ep_list))]
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or self.concurrency) as executor:
             future_to_idx = {
-                executor.submit(self.fetch_episode, ep, i+1): i 
+                executor.submit(fetch, ep, i+1): i
                 for i, ep in enumerate(ep_list)
             }
             for future in concurrent.futures.as_completed(future_to_idx):
@@ -257,134 +278,120 @@ class NovelpiaClient:
                     results[idx] = res
                 except Exception as e:
                     results[idx] = {"error": str(e), "idx": idx+1}
+                if result_cb:
+                    result_cb(idx, results[idx])
                 if progress_cb:
                     progress_cb()
         return results
 
+def _log_request(session, method, url, attempt, max_retries, headers, params, json):
+    # one print per request, so lines from concurrent workers do not interleave
+    lines = [f"[api]   -> {method} {url} (attempt {attempt}/{max_retries})"]
+    try:
+        eff_headers = dict(getattr(session, "headers", {}) or {})
+        if headers:
+            eff_headers.update(headers)
+        lines.append(f"[api]   headers: {j(mask_kv(eff_headers))}")
+    except Exception as e:
+        lines.append(f"[api]   req-headers: <unavailable> ({e})")
+    if params:
+        lines.append(f"[api]   params:  {j(mask_kv(params))}")
+    if json is not None:
+        lines.append(f"[api]   json:    {j(mask_kv(json))}")
+    print("\n".join(lines))
+
+def _log_response(r):
+    print(f"[api]   <- {r.status_code} {r.reason} from {r.url}\n[api]   <- Response content: {r.text}")
+
 def request_with_retries(session: requests.Session, method: str, url: str, *,
                           headers=None, params=None, json=None, data=None,
                           timeout=30, max_retries=3, backoff=1.25,
                           allow_refresh=False, refresh_fn=None,
                           login_fn=None, on_rate_limit=None):
-    """Generic request wrapper: retries on 5xx, 429, and network issues.
-    If allow_refresh is True and the response indicates an expired token, invoke
+    """Request wrapper for the cases a status-based retry cannot express.
+    Network errors and 5xx are retried by the session adapter (see NovelpiaClient).
+    Here 429 is retried with backoff so on_rate_limit() can slow every caller down,
+    and if allow_refresh is True and the response indicates an expired token, invoke
     refresh_fn() followed by login_fn() if needed, then retry.
     """
     attempt = 0
-    last_exc = None
     did_refresh = False
     did_login = False
-    while attempt < max_retries:
+    while True:
         attempt += 1
-        try:
-            # Inject Cookie header (except for login endpoint) using session cookies
-            try:
-                if "/v1/member/login" not in url:
-                    attach_auth_cookies(session, headers)
-            except Exception as e:
-                print(f"Error occurred while attaching auth cookies: {e}")
-                pass
-
-            if const.HTTP_LOG:
-                print(f"[api]   -> {method} {url} (attempt {attempt}/{max_retries})")
-                try:
-                    eff_headers = {}
-                    try:
-                        eff_headers.update(getattr(session, "headers", {}) or {})
-                    except Exception as e:
-                        print(f"Error occurred while fetching session headers: {e}")
-                        pass
-                    if headers:
-                        eff_headers.update(headers)
-                except Exception as e:
-                    print(f"[api]   req-headers: <unavailable> ({e})")
-                if params:
-                    print(f"[api]   params:  {j(mask_kv(params))}")
-                if json is not None:
-                    print(f"[api]   json:    {j(mask_kv(json))}")
+        # USERKEY/TKEY travel in the session cookie jar; no per-request Cookie header is built
+        if const.HTTP_LOG:
+            _log_request(session, method, url, attempt, max_retries, headers, params, json)
 
+        try:
             r = session.request(method, url, headers=headers, params=params, json=json, data=data, timeout=timeout)
-
-            if const.HTTP_LOG and r.status_code != 200:
-                print(f"[api]   <- {r.status_code} {r.reason} from {r.url}")
-                print(f"[api]   <- Response content: {r.text}")
-            
-            # Handle rate limiting (429)
-            if r.status_code == 429:
-                if on_rate_limit:
-                    on_rate_limit()
-                wait = max(5.0, backoff ** (attempt + 2)) + random.uniform(0.5, 1.5)
-                if const.HTTP_LOG:
-                    print(f"[api] !! Rate limit (429) hit. Waiting {wait:.1f}s...")
-                time.sleep(wait)
-                continue
-
-            # Handle too many requests or server errors (5xx)
-            if r.status_code >= 500:
-                if on_rate_limit:
-                    on_rate_limit()
-                wait = max(5.0, backoff ** (attempt + 2)) + random.uniform(0.5, 1.5)
-                if const.HTTP_LOG:
-                    print(f"[api] !! Server error ({r.status_code}). Retrying after backoff...")
-                time.sleep(wait)
-                continue
-
-            # Handle auth refresh-and-retry for all endpoints except login/refresh
-            if allow_refresh and (refresh_fn or login_fn) and not did_login:
-                trigger_refresh = False
-                if r.status_code in (401, 403):
-                    trigger_refresh = True
-                else:
-                    msg = ""
-                    try:
-                        body = r.json()
-                        msg = (body.get("errmsg") or body.get("message") or "").lower()
-                    except Exception:
-                        pass
-                    if "token" in msg and "expire" in msg:
-                        trigger_refresh = True
-
-                if trigger_refresh:
-                    try:
-                        success = False
-                        # Try refresh first
-                        if refresh_fn and not did_refresh:
-                            if const.HTTP_LOG: print("[api] Session expired, trying refresh...")
-                            try:
-                                refresh_fn()
-                                did_refresh = True
-                                success = True
-                            except Exception:
-                                if const.HTTP_LOG: print("[api] Refresh failed.")
-                        
-                        # Try full login if refresh failed or not available
-                        if not success and login_fn and not did_login:
-                            if const.HTTP_LOG: print("[api] Refresh failed or unavailable, trying full re-login...")
-                            try:
-                                login_fn()
-                                did_login = True
-                                success = True
-                            except Exception as e:
-                                if const.HTTP_LOG: print(f"[api] Re-login failed: {e}")
-
-                        if success:
-                            # Retry original request once
-                            r = session.request(method, url, headers=headers, params=params, json=json, data=data, timeout=timeout)
-                    except Exception as e:
-                        if const.HTTP_LOG: print(f"[api] Auth recovery failed: {e}")
-
-            if r.json and r.status_code >= 500 and attempt < max_retries:
-                time.sleep(backoff ** attempt)
-                continue
-            return r
         except requests.RequestException as e:
             if const.HTTP_LOG:
                 print(f"[api] !! {method} {url} failed on attempt {attempt}: {e}")
-            last_exc = e
-            if attempt < max_retries:
-                time.sleep(backoff ** attempt)
-                continue
             raise
-    if last_exc:
-        raise last_exc
-    return r
\ No newline at end of file
+
+        if const.HTTP_LOG and r.status_code != 200:
+            _log_response(r)
+
+        # Handle rate limiting (429)
+        if r.status_code == 429 and attempt < max_retries:
+            if on_rate_limit:
+                on_rate_limit()
+            wait = max(5.0, backoff ** (attempt + 2)) + random.uniform(0.5, 1.5)
+            if const.HTTP_LOG:
+                print(f"[api] !! Rate limit (429) hit. Waiting {wait:.1f}s...")
+            time.sleep(wait)
+            continue
+
+        # Server errors (5xx) that survived the adapter retries
+        if r.status_code >= 500:
+            if on_rate_limit:
+                on_rate_limit()
+            if const.HTTP_LOG:
+                print(f"[api] !! Server error ({r.status_code}) after adapter retries.")
+
+        # Handle auth refresh-and-retry for all endpoints except login/refresh
+        if allow_refresh and (refresh_fn or login_fn) and not did_login:
+            trigger_refresh = False
+            if r.status_code in (401, 403):
+                trigger_refresh = True
+            else:
+                msg = ""
+                try:
+                    body = json_of(r)
+                    msg = (body.get("errmsg") or body.get("message") or "").lower()
+                except Exception:
+                    pass
+                if "token" in msg and "expire" in msg:
+                    trigger_refresh = True
+
+            if trigger_refresh:
+                try:
+                    success = False
+                    # Try refresh first
+                    if refresh_fn and not did_refresh:
+                        if const.HTTP_LOG: print("[api] Session expired, trying refresh...")
+                        try:
+                            refresh_fn()
+                            did_refresh = True
+                            success = True
+                        except Exception:
+                            if const.HTTP_LOG: print("[api] Refresh failed.")
+                    
+                    # Try full login if refresh failed or not available
+                    if not success and login_fn and not did_login:
+                        if const.HTTP_LOG: print("[api] Refresh failed or unavailable, trying full re-login...")
+                        try:
+                            login_fn()
+                            did_login = True
+                            success = True
+                        except Exception as e:
+                            if const.HTTP_LOG: print(f"[api] Re-login failed: {e}")
+
+                    if success:
+                        # Retry original request once
+                        r = session.request(method, url, headers=headers, params=params, json=json, data=data, timeout=timeout)
+                except Exception as e:
+                    if const.HTTP_LOG: print(f"[api] Auth recovery failed: {e}")
+
+        return r
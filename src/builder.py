@@ -1,18 +1,22 @@
-import json
 import os
 from typing import List
 
-from bs4 import BeautifulSoup
+import orjson
 from tqdm import tqdm
+from src.cache import EpisodeCache
 from src.epub import EpubBuilder
 from src.helper import ensure_dir, kebab, sanitize_filename
-from src.novel import fetch_novel_and_episodes
+from src.novel import episode_text, fetch_novel_and_episodes
 
 # ----------------------------
 # Main Build Function
 # ----------------------------
 
-def build_epub(client, novel_id, out_dir, start_chapter=None, end_chapter=None, max_chapters=None, language="en", debug_dump=False):
+def _episode_cache(book_dir, use_cache, refresh_cache):
+    return EpisodeCache(os.path.join(book_dir, ".cache"), refresh=refresh_cache) if use_cache else None
+
+def build_epub(client, novel_id, out_dir, start_chapter=None, end_chapter=None, max_chapters=None, language="en", debug_dump=False,
+               use_cache=True, refresh_cache=False):
     data_novel, ep_list, title = fetch_novel_and_episodes(client, novel_id, start_chapter, end_chapter, max_chapters)
 
     builder = EpubBuilder(out_dir, debug_dump=debug_dump)
@@ -27,16 +31,20 @@ def build_epub(client, novel_id, out_dir, start_chapter=None, end_chapter=None,
         novel=data_novel,
         episodes=ep_list,
         filename_hint=title,
+        slug=base,
         language=language,
         novel_id=novel_id,
+        cache=_episode_cache(book_dir, use_cache, refresh_cache),
     )
 
-def build_txt(client, novel_id, out_dir, start_chapter=None, end_chapter=None, max_chapters=None, language="en", debug_dump=False):
+def build_txt(client, novel_id, out_dir, start_chapter=None, end_chapter=None, max_chapters=None, language="en", debug_dump=False,
+              use_cache=True, refresh_cache=False):
     data_novel, ep_list, title = fetch_novel_and_episodes(client, novel_id, start_chapter, end_chapter, max_chapters)
 
     base = kebab(title)
     book_dir = os.path.join(out_dir, base)
     ensure_dir(book_dir)
+    build_metadata(book_dir, data_novel, novel_id, ep_list, max_chapters)
 
     total = 0
     pbar = tqdm(total=len(ep_list), desc="Exporting TXT", unit="chap")
@@ -44,7 +52,14 @@ def build_txt(client, novel_id, out_dir, start_chapter=None, end_chapter=None, m
     def update_pbar():
         pbar.update(1)
 
-    fetched_results = client.fetch_episodes_parallel(ep_list, progress_cb=update_pbar)
+    def prepare(res):
+        # text extraction runs on the worker thread, overlapping the other fetches
+        res["text"] = episode_text(res.pop("html"))
+
+    fetched_results = client.fetch_episodes_parallel(
+        ep_list, progress_cb=update_pbar, worker_cb=prepare,
+        cache=_episode_cache(book_dir, use_cache, refresh_cache),
+    )
     pbar.close()
 
     for i, res in enumerate(fetched_results, 1):
@@ -53,19 +68,14 @@ def build_txt(client, novel_id, out_dir, start_chapter=None, end_chapter=None, m
             print(f"[warn] Failed to fetch chapter {i}: {err}")
             continue
 
-        html_text = res["html"]
+        text = res["text"]
         epi_title = res["epi_title"]
 
-        soup = BeautifulSoup(html_text, "html.parser")
-        text = soup.get_text("\n")
-
         fname = f"{i}_{sanitize_filename(epi_title)}.txt"
         with open(os.path.join(book_dir, fname), "w", encoding="utf-8") as f:
             f.write(text)
 
         total += 1
-    
-    build_metadata(book_dir, data_novel, novel_id, ep_list, max_chapters)
 
     return book_dir, title, total
 
@@ -82,21 +92,16 @@ def build_metadata(book_dir, data_novel, novel_id, ep_list, max_chapters=None):
     tag_items = (data_novel.get("result", {}).get("tag_list")
                  or nv.get("tag_list")
                  or [])
-    tags: List[str] = []
-    for t in tag_items:
-        if isinstance(t, str):
-            tags.append(t)
-        elif isinstance(t, dict):
-            val = t.get("tag_name") or t.get("name") or t.get("title")
-            if isinstance(val, str):
-                tags.append(val)
-    # unique while preserving order
+    # unique while preserving order, deduplicated as tags are collected
     seen = set()
-    uniq_tags = []
-    for t in tags:
-        if t not in seen:
-            seen.add(t)
-            uniq_tags.append(t)
+    uniq_tags: List[str] = []
+    for t in tag_items:
+        val = t if isinstance(t, str) else (
+            (t.get("tag_name") or t.get("name") or t.get("title")) if isinstance(t, dict) else None
+        )
+        if isinstance(val, str) and val not in seen:
+            seen.add(val)
+            uniq_tags.append(val)
 
     meta = {
         "url": f"https://global.novelpia.com/novel/{novel_id}",
@@ -109,13 +114,16 @@ def build_metadata(book_dir, data_novel, novel_id, ep_list, max_chapters=None):
     }
 
     meta_path = os.path.join(book_dir, "metadata.json")
-    with open(meta_path, "w", encoding="utf-8") as f:
-        json.dump(meta, f, ensure_ascii=False, indent=2)
-
+    with open(meta_path, "wb") as f:
+        f.write(orjson.dumps(meta, option=orjson.OPT_INDENT_2))
+
+    # one record per line, encoded up front and written in a single call
+    lines = []
+    for idx, ep in enumerate(ep_list, 1):
+        epi_no = int(ep.get("episode_no"))
+        epi_title = ep.get("epi_title") or f"Episode {ep.get('epi_num')}"
+        rec = {"idx": idx, "title": epi_title, "url": f"https://global.novelpia.com/viewer/{epi_no}"}
+        lines.append(orjson.dumps(rec, option=orjson.OPT_APPEND_NEWLINE))
     chapters_path = os.path.join(book_dir, "chapters.jsonl")
-    with open(chapters_path, "w", encoding="utf-8") as f:
-        for idx, ep in enumerate(ep_list, 1):
-            epi_no = int(ep.get("episode_no"))
-            epi_title = ep.get("epi_title") or f"Episode {ep.get('epi_num')}"
-            rec = {"idx": idx, "title": epi_title, "url": f"https://global.novelpia.com/viewer/{epi_no}"}
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
\ No newline at end of file
+    with open(chapters_path, "wb") as f:
+        f.write(b"".join(lines))
\ No newline at end of file
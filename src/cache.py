@@ -0,0 +1,41 @@
+import gzip
+import os
+
+from typing import Optional
+from src.helper import ensure_dir
+
+# ----------------------------
+# Episode Cache
+# ----------------------------
+
+class EpisodeCache:
+    """Gzipped episode HTML on disk, keyed by episode_no.
+
+    With refresh=True every lookup misses, but fetched episodes are still stored.
+    """
+    def __init__(self, cache_dir: str, refresh: bool = False):
+        self.cache_dir = cache_dir
+        self.refresh = refresh
+        ensure_dir(cache_dir)
+
+    def _path(self, epi_no: int) -> str:
+        return os.path.join(self.cache_dir, f"{epi_no}.html.gz")
+
+    def get(self, epi_no: int) -> Optional[str]:
+        if self.refresh:
+            return None
+        try:
+            with open(self._path(epi_no), "rb") as f:
+                return gzip.decompress(f.read()).decode("utf-8")
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"[warn] Ignoring unreadable cache entry for episode {epi_no}: {e}")
+            return None
+
+    def put(self, epi_no: int, html_text: str):
+        path = self._path(epi_no)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(gzip.compress(html_text.encode("utf-8"), compresslevel=6))
+        os.replace(tmp, path)
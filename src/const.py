@@ -6,8 +6,11 @@ from pathlib import Path
 
 BASE_URL = "https://global.novelpia.com"
 API_BASE = "https://api-global.novelpia.com"
-IMG_BASE_HTTPS = "https:"
 HTTP_LOG = False 
+HTTP_POOL_SIZE = 32
+IMAGE_WORKERS = 16
+# --workers above this no longer raise the episode request rate
+MAX_THROTTLED_WORKERS = 3
 CONFIG_PATH = Path(__file__).resolve().parent.parent / ".api.json"
 
 SESSION_HEADERS = {
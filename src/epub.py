@@ -1,15 +1,216 @@
 import html
+import itertools
 import os
+import shutil
 import time
+import zipfile
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
 from typing import Dict, List, Optional, Tuple
-from urllib.parse import urlparse
-from bs4 import BeautifulSoup
-from ebooklib import epub
+from lxml.html import HtmlElement
 from tqdm import tqdm
 from src.api import NovelpiaClient
-from src.const import BASE_URL
-from src.helper import ensure_dir, kebab, media_type_from_ext, normalize_url
+from src.cache import EpisodeCache
+from src.const import BASE_URL, IMAGE_WORKERS
+from src.helper import ensure_dir, image_ext_from_url, kebab, media_type_from_ext, normalize_url
+from src.novel import fragment_xhtml, parse_episode_html
+
+# ----------------------------
+# EPUB Writer
+# ----------------------------
+
+_CONTAINER_XML = """<?xml version="1.0" encoding="utf-8"?>
+<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">
+  <rootfiles>
+    <rootfile media-type="application/oebps-package+xml" full-path="EPUB/content.opf"/>
+  </rootfiles>
+</container>
+"""
+
+_PAGE_OPEN = (
+    "<?xml version='1.0' encoding='utf-8'?>\n<!DOCTYPE html>\n"
+    '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" '
+)
+_CHAPTER_HEAD_CLOSE = '</title><link rel="stylesheet" type="text/css" href="style/main.css"/></head><body>'
+_CHAPTER_CLOSE = "</body></html>"
+_CHAPTER_TITLE_OPEN = '<h2 class="epi-title">'
+_CHAPTER_TITLE_CLOSE = "</h2>"
+
+_DEFAULT_CSS = b"""
+body { font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Arial; line-height: 1.6; }
+h1, h2, h3 { page-break-after: avoid; }
+img { max-width: 100%; height: auto; }
+.epi-title { font-size: 1.4em; font-weight: 600; margin: 0 0 0.6em; }
+"""
+_ABOUT_COVER = (
+    "<p><img src='cover.jpg' alt='Cover' style='width:230px;max-width:90%;height:auto;"
+    "border-radius:12px;box-shadow:0 2px 8px rgba(0,0,0,.15)'/></p>"
+)
+
+_SPOOL_MAX_BYTES = 256 * 1024
+
+# already-compressed formats gain nothing from deflate, so they are stored as-is
+_STORED_MEDIA_TYPES = frozenset(("image/jpeg", "image/png", "image/gif", "image/webp"))
+
+def _attr(value: str) -> str:
+    return html.escape(value, quote=True)
+
+class EpubWriter:
+    """Writes an EPUB 3 package straight into a zip, one item at a time.
+
+    Only the manifest and page entries are kept in memory; content.opf,
+    toc.ncx and nav.xhtml are generated from them on close(). The archive is
+    built in a .part file next to path and only replaces it once complete, so a
+    failed or interrupted build leaves any previous EPUB untouched.
+    """
+    def __init__(self, path: str, identifier: str, title: str, language: str, author: str):
+        self.identifier = identifier
+        self.title = title
+        self.language = language
+        self.author = author
+        self.manifest: List[Tuple[str, str, str, Optional[str]]] = []
+        self.pages: List[Tuple[int, str, str, str]] = []
+        self.cover_uid: Optional[str] = None
+        self.path = path
+        self.tmp_path = path + ".part"
+        self.zf = zipfile.ZipFile(self.tmp_path, "w", zipfile.ZIP_DEFLATED, compresslevel=6)
+        self.zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        self.zf.writestr("META-INF/container.xml", _CONTAINER_XML)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            try:
+                self.close()
+                return
+            except BaseException:
+                self._discard()
+                raise
+        self._discard()
+
+    def _discard(self):
+        self.zf.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+    def _zip_info(self, file_name: str, media_type: str) -> zipfile.ZipInfo:
+        zi = zipfile.ZipInfo(f"EPUB/{file_name}", date_time=time.localtime()[:6])
+        zi.compress_type = zipfile.ZIP_STORED if media_type in _STORED_MEDIA_TYPES else zipfile.ZIP_DEFLATED
+        zi.external_attr = 0o644 << 16  # rw-r--r-- on extraction; a bare ZipInfo defaults to mode 0
+        return zi
+
+    def add_item(self, uid: str, file_name: str, media_type: str, content,
+                 properties: Optional[str] = None):
+        self.zf.writestr(self._zip_info(file_name, media_type), content)
+        self.manifest.append((uid, file_name, media_type, properties))
+
+    def add_spool(self, uid: str, file_name: str, media_type: str, spool):
+        """Copy a spooled download into the archive without reading it into memory."""
+        spool.seek(0)
+        with self.zf.open(self._zip_info(file_name, media_type), "w") as dst:
+            shutil.copyfileobj(spool, dst, 64 * 1024)
+        self.manifest.append((uid, file_name, media_type, None))
+
+    def add_cover(self, file_name: str, media_type: str, content: bytes):
+        self.cover_uid = "cover-img"
+        self.add_item(self.cover_uid, file_name, media_type, content, properties="cover-image")
+
+    def add_page(self, uid: str, file_name: str, title: str, body: str, order: int = 0):
+        """Add an XHTML page to the spine and TOC; body must already be well-formed XHTML.
+
+        Pages may be added in any order; the spine and TOC are sorted by order on close.
+        """
+        lang = _attr(self.language)
+        self.add_item(uid, file_name, "application/xhtml+xml", "".join((
+            _PAGE_OPEN, f'lang="{lang}" xml:lang="{lang}"><head><title>', html.escape(title),
+            _CHAPTER_HEAD_CLOSE, body, _CHAPTER_CLOSE,
+        )))
+        self.pages.append((order, uid, file_name, title))
+
+    def close(self):
+        self.pages.sort(key=lambda p: p[0])
+        self.add_item("ncx", "toc.ncx", "application/x-dtbncx+xml", self._ncx())
+        self.add_item("nav", "nav.xhtml", "application/xhtml+xml", self._nav(), properties="nav")
+        self.zf.writestr(self._zip_info("content.opf", "application/oebps-package+xml"), self._opf())
+        self.zf.close()
+        os.replace(self.tmp_path, self.path)
+
+    def _opf(self) -> str:
+        modified = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        cover_meta = f'\n    <meta name="cover" content="{self.cover_uid}"/>' if self.cover_uid else ""
+        items = "\n".join(
+            f'    <item href="{_attr(href)}" id="{_attr(uid)}" media-type="{media_type}"'
+            + (f' properties="{props}"' if props else "") + "/>"
+            for uid, href, media_type, props in self.manifest
+        )
+        itemrefs = "\n".join(f'    <itemref idref="{_attr(uid)}"/>'
+                             for uid in ["nav"] + [p[1] for p in self.pages])
+        return f"""<?xml version='1.0' encoding='utf-8'?>
+<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="id" version="3.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+    <meta property="dcterms:modified">{modified}</meta>
+    <dc:identifier id="id">{html.escape(self.identifier)}</dc:identifier>
+    <dc:title>{html.escape(self.title)}</dc:title>
+    <dc:language>{html.escape(self.language)}</dc:language>
+    <dc:creator id="creator">{html.escape(self.author)}</dc:creator>{cover_meta}
+  </metadata>
+  <manifest>
+{items}
+  </manifest>
+  <spine toc="ncx">
+{itemrefs}
+  </spine>
+</package>
+"""
+
+    def _ncx(self) -> str:
+        points = "\n".join(
+            f'    <navPoint id="np{n}" playOrder="{n}"><navLabel><text>{html.escape(title)}</text></navLabel>'
+            f'<content src="{_attr(href)}"/></navPoint>'
+            for n, (_, _, href, title) in enumerate(self.pages, 1)
+        )
+        return f"""<?xml version='1.0' encoding='utf-8'?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <head>
+    <meta content="{_attr(self.identifier)}" name="dtb:uid"/>
+    <meta content="1" name="dtb:depth"/>
+    <meta content="0" name="dtb:totalPageCount"/>
+    <meta content="0" name="dtb:maxPageNumber"/>
+  </head>
+  <docTitle>
+    <text>{html.escape(self.title)}</text>
+  </docTitle>
+  <navMap>
+{points}
+  </navMap>
+</ncx>
+"""
+
+    def _nav(self) -> str:
+        lang = _attr(self.language)
+        entries = "\n".join(
+            f'        <li><a href="{_attr(href)}">{html.escape(title)}</a></li>'
+            for _, _, href, title in self.pages
+        )
+        return f"""{_PAGE_OPEN}lang="{lang}" xml:lang="{lang}">
+  <head>
+    <title>{html.escape(self.title)}</title>
+  </head>
+  <body>
+    <nav epub:type="toc" id="id" role="doc-toc">
+      <h2>{html.escape(self.title)}</h2>
+      <ol>
+{entries}
+      </ol>
+    </nav>
+  </body>
+</html>
+"""
 
 # ----------------------------
 # EPUB Builder
@@ -21,26 +222,48 @@ class EpubBuilder:
         self.debug_dump = debug_dump
         ensure_dir(out_dir)
 
-    def _fetch_bytes(self, client: NovelpiaClient, url: str) -> Optional[bytes]:
+    def _fetch_spooled(self, client: NovelpiaClient, url: str) -> Optional[SpooledTemporaryFile]:
+        """Stream url into a spool that stays in memory up to _SPOOL_MAX_BYTES, then moves to disk.
+
+        Network errors and 5xx are already retried by the session adapter, so only
+        429 (which the adapter passes through) is retried here.
+        """
         for attempt in range(1, 4):
             try:
-                resp = client.s.get(url, timeout=client.timeout)
-                if resp.status_code == 429:
-                    wait = 2.0 * attempt
-                    time.sleep(wait)
-                    continue
-                resp.raise_for_status()
-                return resp.content
+                with client.s.get(url, timeout=client.timeout, stream=True) as resp:
+                    if resp.status_code == 429:
+                        if attempt < 3:
+                            time.sleep(2.0 * attempt)
+                        continue
+                    resp.raise_for_status()
+                    spool = SpooledTemporaryFile(max_size=_SPOOL_MAX_BYTES)
+                    try:
+                        for chunk in resp.iter_content(chunk_size=64 * 1024):
+                            spool.write(chunk)
+                    except Exception:
+                        spool.close()
+                        raise
+                    if not spool.tell():
+                        spool.close()
+                        return None
+                    return spool
             except Exception:
-                if attempt < 3:
-                    time.sleep(1.0)
-                continue
+                return None
         return None
 
+    def _fetch_bytes(self, client: NovelpiaClient, url: str) -> Optional[bytes]:
+        spool = self._fetch_spooled(client, url)
+        if spool is None:
+            return None
+        with spool:
+            spool.seek(0)
+            return spool.read()
+
     def build(self, client: NovelpiaClient, novel: Dict, episodes: List[Dict],
               filename_hint: Optional[str] = None, language: str = "en",
               author_fallback: str = "Unknown", css_text: Optional[str] = None,
-              novel_id: Optional[int] = None) -> Tuple[str, str, int]:
+              novel_id: Optional[int] = None, cache: Optional[EpisodeCache] = None,
+              slug: Optional[str] = None) -> Tuple[str, str, int]:
         nv = novel["result"]["novel"]
         title = nv.get("novel_name", f"novel_{nv.get('novel_no','')}")
         writers = novel["result"].get("writer_list") or []
@@ -48,145 +271,117 @@ class EpubBuilder:
         status = "Completed" if str(nv.get("flag_complete", 0)) == "1" else "Ongoing"
         description = (nv.get("novel_story") or "").strip()
 
-        book = epub.EpubBook()
-        book.set_identifier(f"novelpia-{nv.get('novel_no')}")
-        book.set_title(title)
-        book.set_language(language)
-        book.add_author(author)
+        # CSS
+        css_bytes = css_text.encode("utf-8") if css_text else _DEFAULT_CSS
 
-        # Cover
-        cover_url = normalize_url(nv.get("novel_full_img") or nv.get("novel_img") or "")
-        cover_bytes = self._fetch_bytes(client, cover_url) if cover_url else None
-        has_cover = False
-        if cover_bytes:
-            book.set_cover("cover.jpg", cover_bytes)
-            has_cover = True
+        base = slug or kebab(filename_hint or title)
+        book_dir = os.path.join(self.out_dir, base)
+        ensure_dir(book_dir)
+        out_path = os.path.join(book_dir, f"{base}.epub")
 
-        # CSS
-        default_css = css_text or (
-            """
-            body { font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Arial; line-height: 1.6; }
-            h1, h2, h3 { page-break-after: avoid; }
-            img { max-width: 100%; height: auto; }
-            .epi-title { font-size: 1.4em; font-weight: 600; margin: 0 0 0.6em; }
-            """
-        )
-        style = epub.EpubItem(uid="style", file_name="style/main.css",
-                              media_type="text/css", content=default_css.encode("utf-8"))
-        book.add_item(style)
-
-        spine: List = ["nav"]
-        toc: List = []
-        image_cache: Dict[str, str] = {}
-        img_index = 1
-
-        def add_images_and_rewrite(html_str: str) -> Tuple[str, List[epub.EpubItem]]:
-            nonlocal img_index
-            soup = BeautifulSoup(html_str, "html.parser")
-            added_items: List[epub.EpubItem] = []
-
-            for img in soup.find_all("img"):
-                src = img.get("src")
-                if not src:
-                    continue
-                src = normalize_url(src)
-                if src in image_cache:
-                    img["src"] = image_cache[src]
-                    continue
-
-                path = urlparse(src).path
-                ext = os.path.splitext(path)[1].lower() or ".jpg"
-                if ext not in (".jpg", ".jpeg", ".png", ".gif", ".webp"):
-                    ext = ".jpg"
-
-                img_bytes = self._fetch_bytes(client, src)
-                if not img_bytes:
+        # Chapters wait here only until their images are in the archive
+        pending: Dict[int, Tuple[str, HtmlElement, List[Tuple[HtmlElement, str]]]] = {}
+        image_futures: Dict[str, Future] = {}
+        image_names: Dict[str, Optional[str]] = {}
+        image_ids = itertools.count(1)
+
+        # Cover and image downloads run on their own pool, overlapping episode fetches
+        with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as asset_pool, \
+                EpubWriter(out_path, f"novelpia-{nv.get('novel_no')}", title, language, author) as writer:
+            cover_url = normalize_url(nv.get("novel_full_img") or nv.get("novel_img") or "")
+            cover_future = asset_pool.submit(self._fetch_bytes, client, cover_url) if cover_url else None
+            writer.add_item("style", "style/main.css", "text/css", css_bytes)
+
+            def write_image(src: str, spool: Optional[SpooledTemporaryFile]):
+                if spool is None:
                     # leave external
-                    continue
-
-                fname = f"images/img_{img_index:05d}{ext}"
-                image_cache[src] = fname
-                img_index += 1
-
-                item = epub.EpubItem(uid=f"img{img_index}", file_name=fname,
-                                     media_type=media_type_from_ext(ext), content=img_bytes)
-                added_items.append(item)
-                img["src"] = fname
-
-            return str(soup), added_items
-
-        # Fetch episodes in parallel
-        pbar = tqdm(total=len(episodes), desc="Fetching chapters", unit="chap")
-        
-        def update_pbar():
-            pbar.update(1)
-
-        fetched_results = client.fetch_episodes_parallel(episodes, progress_cb=update_pbar)
-        pbar.close()
-
-        for i, res in enumerate(fetched_results, 1):
-            if not res or "error" in res:
-                err = res.get("error") if res else "Unknown error"
-                print(f"[warn] Failed to fetch chapter {i}: {err}")
-                continue
-
-            html_text = res["html"]
-            epi_title = res["epi_title"]
-            
-            html_text, new_imgs = add_images_and_rewrite(html_text)
-
-            chapter = epub.EpubHtml(
-                title=epi_title,
-                file_name=f"chap_{i:04d}.xhtml",
-                lang=language,
-                content=(
-                    f"<html xmlns=\"http://www.w3.org/1999/xhtml\">"
-                    f"<head><title>{html.escape(epi_title)}</title>"
-                    f"<link rel=\"stylesheet\" href=\"style/main.css\"/></head>"
-                    f"<body><h2 class=\"epi-title\">{html.escape(epi_title)}</h2>{html_text}</body></html>"
-                ),
-            )
-
-            book.add_item(chapter)
-            spine.append(chapter)
-            toc.append(chapter)
-
-            for item in new_imgs:
-                book.add_item(item)
-
-        # About / metadata page
-        src_url = f"{BASE_URL}/novel/{novel_id}" if novel_id else ""
-        meta_parts = []
-        meta_parts.append(f"<h1>{html.escape(title)}</h1>")
-        if has_cover:
-            meta_parts.append("<p><img src='cover.jpg' alt='Cover' style='width:230px;max-width:90%;height:auto;border-radius:12px;box-shadow:0 2px 8px rgba(0,0,0,.15)'/></p>")
-        meta_parts.append(f"<p><strong>Author:</strong> {html.escape(author)}</p>")
-        meta_parts.append(f"<p><strong>Chapters:</strong> {len(episodes)}</p>")
-        meta_parts.append(f"<p><strong>Status:</strong> {html.escape(status)}</p>")
-        if src_url:
-            meta_parts.append(f"<p><strong>Source:</strong> <a href='{src_url}'>{src_url}</a></p>")
-        if description:
-            meta_parts.append(f"<p>{html.escape(description)}</p>")
-        meta_html = (
-            "<html><head><link rel='stylesheet' href='style/main.css'/></head><body>"
-             + "".join(meta_parts) + "</body></html>"
-        )
-        about = epub.EpubHtml(title="About", file_name="about.xhtml", lang=language, content=meta_html)
-        book.add_item(about)
-        spine.insert(1, about)
-        toc.insert(0, about)
+                    image_names[src] = None
+                    return
+                with spool:
+                    ext = image_ext_from_url(src)
+                    img_index = next(image_ids)
+                    fname = f"images/img_{img_index:05d}{ext}"
+                    writer.add_spool(f"img{img_index}", fname, media_type_from_ext(ext), spool)
+                image_names[src] = fname
 
-        # TOC, NCX, Nav
-        book.toc = toc
-        book.add_item(epub.EpubNcx())
-        book.add_item(epub.EpubNav())
+            def flush(wait: bool = False):
+                # Only the calling thread touches the writer, so images land here once downloaded
+                done = list(image_futures) if wait else [k for k, f in image_futures.items() if f.done()]
+                for src in tqdm(done, desc="Fetching images", unit="img", disable=not (wait and done)):
+                    write_image(src, image_futures.pop(src).result())
 
-        # Spine & CSS
-        book.spine = spine
+                for i in [i for i, (_, _, imgs) in pending.items()
+                          if all(src in image_names for _, src in imgs)]:
+                    epi_title, root, imgs = pending.pop(i)
+                    for img, src in imgs:
+                        if image_names[src]:
+                            img.attrib["src"] = image_names[src]
+                    writer.add_page(
+                        f"chap_{i:04d}", f"chap_{i:04d}.xhtml", epi_title,
+                        "".join((_CHAPTER_TITLE_OPEN, html.escape(epi_title), _CHAPTER_TITLE_CLOSE,
+                                 fragment_xhtml(root))),
+                        order=i,
+                    )
+
+            def prepare(res: Dict):
+                # Parse on the episode worker thread so it overlaps the other fetches;
+                # the raw HTML is dropped so finished chapters are not kept around
+                res["parsed"] = parse_episode_html(res.pop("html"))
+
+            def on_result(idx: int, res: Dict):
+                # Queue each chapter's unseen images as it arrives
+                if not res or "error" in res:
+                    return
+                root, imgs = res.pop("parsed")
+                for _, src in imgs:
+                    if src not in image_futures and src not in image_names:
+                        image_futures[src] = asset_pool.submit(self._fetch_spooled, client, src)
+                pending[idx + 1] = (res["epi_title"], root, imgs)
+                flush()
+
+            try:
+                # Fetch episodes in parallel
+                pbar = tqdm(total=len(episodes), desc="Fetching chapters", unit="chap")
+
+                def update_pbar():
+                    pbar.update(1)
+
+                fetched_results = client.fetch_episodes_parallel(
+                    episodes, progress_cb=update_pbar, result_cb=on_result, cache=cache, worker_cb=prepare,
+                )
+                pbar.close()
+                flush(wait=True)
+            finally:
+                for future in image_futures.values():
+                    spool = future.result()
+                    if spool is not None:
+                        spool.close()
+
+            for i, res in enumerate(fetched_results, 1):
+                if not res or "error" in res:
+                    err = res.get("error") if res else "Unknown error"
+                    print(f"[warn] Failed to fetch chapter {i}: {err}")
+
+            # Cover
+            cover_bytes = cover_future.result() if cover_future else None
+            has_cover = False
+            if cover_bytes:
+                writer.add_cover("cover.jpg", "image/jpeg", cover_bytes)
+                has_cover = True
+
+            # About / metadata page
+            src_url = f"{BASE_URL}/novel/{novel_id}" if novel_id else ""
+            meta_parts = []
+            meta_parts.append(f"<h1>{html.escape(title)}</h1>")
+            if has_cover:
+                meta_parts.append(_ABOUT_COVER)
+            meta_parts.append(f"<p><strong>Author:</strong> {html.escape(author)}</p>")
+            meta_parts.append(f"<p><strong>Chapters:</strong> {len(episodes)}</p>")
+            meta_parts.append(f"<p><strong>Status:</strong> {html.escape(status)}</p>")
+            if src_url:
+                meta_parts.append(f"<p><strong>Source:</strong> <a href='{src_url}'>{src_url}</a></p>")
+            if description:
+                meta_parts.append(f"<p>{html.escape(description)}</p>")
+            writer.add_page("about", "about.xhtml", "About", "".join(meta_parts), order=0)
 
-        base = kebab(filename_hint or title)
-        book_dir = os.path.join(self.out_dir, base)
-        ensure_dir(book_dir)
-        out_path = os.path.join(book_dir, f"{base}.epub")
-        epub.write_epub(out_path, book, {})
         return out_path, title, len(episodes)
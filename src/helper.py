@@ -1,13 +1,26 @@
 
-import base64
-import json
 import os
 import re
+import tempfile
+import threading
+import time
 
 from typing import Any, Dict, Optional, Tuple
 from urllib.parse import parse_qs, urljoin, urlparse
+import orjson
 import requests
-from src.const import BASE_URL, CONFIG_PATH, IMG_BASE_HTTPS
+from src.const import BASE_URL, CONFIG_PATH
+
+_SANITIZE_RE = re.compile(r'[\\/:*?"<>|]+')
+_KEBAB_RE = re.compile(r"[^a-z0-9]+")
+_B64URL_RE = re.compile(r"[A-Za-z0-9_-]*={0,2}")
+_MEDIA_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
 
 # ----------------------------
 # Helpers
@@ -17,28 +30,19 @@ def ensure_dir(path: str):
     os.makedirs(path, exist_ok=True)
 
 def sanitize_filename(name: str) -> str:
-    return re.sub(r'[\\/:*?"<>|]+', "_", (name or "").strip()) or "book"
+    return _SANITIZE_RE.sub("_", (name or "").strip()) or "book"
 
 def normalize_url(u: str) -> str:
-    if not u:
-        return u
-    if u.startswith("//"):
-        return IMG_BASE_HTTPS + u
-    if u.startswith("/"):
-        return urljoin(BASE_URL, u)
-    return u
+    # protocol-relative, root-relative and relative URLs all resolve against the site
+    return urljoin(BASE_URL + "/", u) if u else u
 
 def media_type_from_ext(ext: str) -> str:
-    ext = ext.lower()
-    if ext in (".jpg", ".jpeg"):
-        return "image/jpeg"
-    if ext == ".png":
-        return "image/png"
-    if ext == ".gif":
-        return "image/gif"
-    if ext == ".webp":
-        return "image/webp"
-    return "image/jpeg"
+    return _MEDIA_TYPES.get(ext.lower(), "image/jpeg")
+
+def image_ext_from_url(url: str) -> str:
+    """File extension for an image URL, falling back to .jpg for unknown types."""
+    ext = os.path.splitext(urlparse(url).path)[1].lower()
+    return ext if ext in _MEDIA_TYPES else ".jpg"
 
 def looks_like_jwt(token: Optional[str]) -> bool:
     if not isinstance(token, str):
@@ -47,38 +51,80 @@ def looks_like_jwt(token: Optional[str]) -> bool:
     if len(parts) != 3:
         return False
     for p in parts:
-        try:
-            base64.urlsafe_b64decode(p + "===")
-        except Exception:
+        # base64url charset and a length that could decode, without decoding
+        if not _B64URL_RE.fullmatch(p) or len(p.rstrip("=")) % 4 == 1:
             return False
     return True
 
 def kebab(s: str) -> str:
     s = (s or "").lower()
-    s = re.sub(r"[^a-z0-9]+", "-", s).strip("-")
+    s = _KEBAB_RE.sub("-", s).strip("-")
     return s or "book"
 
+# ----------------------------
+# Rate limiting
+# ----------------------------
+
+class RateLimiter:
+    """Space out calls shared by several threads.
+
+    interval_fn is evaluated on every acquire so throttle changes made after a
+    rate limit (429) apply to all workers at once.
+    """
+    def __init__(self, interval_fn):
+        self._interval_fn = interval_fn
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_at)
+            self._next_at = start + max(0.0, self._interval_fn())
+        if start > now:
+            time.sleep(start - now)
+
 # ----------------------------
 # Config management
 # ----------------------------
 
-def load_config() -> Dict[str, Any]:
+def load_config(use_env: bool = True) -> Dict[str, Any]:
+    # Tokens supplied via environment skip the config file entirely
+    if use_env:
+        env_login_at = (os.getenv("NOVELPIA_LOGIN_AT") or "").strip()
+        env_userkey = (os.getenv("NOVELPIA_USERKEY") or "").strip()
+        if env_login_at and env_userkey:
+            return {
+                "login_at": env_login_at,
+                "userkey": env_userkey,
+                "tkey": (os.getenv("NOVELPIA_TKEY") or "").strip(),
+            }
     try:
         if os.path.exists(CONFIG_PATH):
-            with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-                return json.load(f) or {}
+            with open(CONFIG_PATH, "rb") as f:
+                return orjson.loads(f.read()) or {}
     except Exception as e:
         print(f"Error occurred while loading config: {e}")
         return {}
     return {}
 
 def save_config(cfg: Dict[str, Any]) -> None:
+    # write to a unique sibling temp file and swap it in, so a crash never leaves a truncated
+    # config and concurrent token refreshes never share (or move away) each other's temp file
+    tmp_path = None
     try:
-        with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-            json.dump(cfg, f, ensure_ascii=False, indent=2)
+        with tempfile.NamedTemporaryFile("wb", dir=CONFIG_PATH.parent, prefix=CONFIG_PATH.name + ".",
+                                         suffix=".tmp", delete=False) as f:
+            tmp_path = f.name
+            f.write(orjson.dumps(cfg, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, CONFIG_PATH)
     except Exception as e:
         print(f"Error occurred while saving config: {e}")
-        pass
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
 
 # ----------------------------
 # Auth token management & header merging
@@ -124,56 +170,32 @@ def mask_kv(d: Optional[dict]) -> Optional[dict]:
             out[k] = _mask_value(v)
     return out
 
+def json_of(r: requests.Response) -> Any:
+    """Decode a response body with orjson instead of requests' stdlib-based .json()."""
+    return orjson.loads(r.content)
+
 def j(x: Any) -> str:
     try:
-        return json.dumps(x, ensure_ascii=False)
+        return orjson.dumps(x).decode("utf-8")
     except Exception:
         return str(x)
     
-def attach_auth_cookies(session, headers=None):
-        ck = getattr(session, "cookies", None)
-        if ck is None:
-            return headers
-
-        uval = None
-        tval = None
-
-        try:
-            for c in ck:
-                if c.name == "USERKEY":
-                    uval = c.value
-                elif c.name == "TKEY":
-                    tval = c.value
-        except Exception as e:
-            print(f"Error occurred while fetching cookies: {e}")
-
-        cookie_parts = []
-        if uval:
-            cookie_parts.append(f"USERKEY={uval}")
-        if tval:
-            cookie_parts.append(f"TKEY={tval}")
-
-        cookie_parts.append("last_login=basic")
-
-        if cookie_parts:
-            headers = dict(headers or {})
-            headers.setdefault("Cookie", "; ".join(cookie_parts))
-
-        return headers
-
 # ----------------------------
 # Token extraction (STRICT)
 # ----------------------------
 
 def iter_strings(obj):
-    if isinstance(obj, str):
-        yield obj
-    elif isinstance(obj, dict):
-        for v in obj.values():
-            yield from iter_strings(v)
-    elif isinstance(obj, list):
-        for v in obj:
-            yield from iter_strings(v)
+    # explicit stack instead of recursion; children pushed reversed to keep document order
+    stack = [obj]
+    while stack:
+        x = stack.pop()
+        t = type(x)
+        if t is str:
+            yield x
+        elif t is dict:
+            stack.extend(reversed(list(x.values())))
+        elif t is list:
+            stack.extend(reversed(x))
 
 def extract_t_token(tdata: dict) -> Tuple[Optional[str], Optional[str]]:
     """Return (token, direct_content_url_or_none).
@@ -204,7 +226,9 @@ def extract_t_token(tdata: dict) -> Tuple[Optional[str], Optional[str]]:
 
     # 3) URL that is the official content endpoint with any _t
     for s in iter_strings(tdata):
-        if isinstance(s, str) and (s.startswith("http://") or s.startswith("https://")):
+        if "api-global.novelpia.com" not in s:
+            continue
+        if s.startswith("http://") or s.startswith("https://"):
             try:
                 p = urlparse(s)
                 if p.netloc.endswith("api-global.novelpia.com") and p.path.endswith("/v1/novel/episode/content"):
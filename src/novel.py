@@ -1,36 +1,51 @@
-from bs4 import BeautifulSoup
+from typing import List, Tuple
+from lxml import etree
+from lxml import html as lxml_html
 from src.helper import normalize_url
 
 # ----------------------------
 # Novelpia Novel & Episodes Fetcher
 # ----------------------------
 
-def html_from_episode_text(raw_html: str) -> str:
-    soup = BeautifulSoup(raw_html or "", "html.parser")
+def _episode_root(raw_html: str) -> lxml_html.HtmlElement:
+    """Parse episode HTML as a fragment under a single <div> parent."""
+    if not (raw_html or "").strip():
+        return lxml_html.Element("div")
+    return lxml_html.fragment_fromstring(raw_html, create_parent="div")
 
-    # normalize images
-    for img in soup.find_all("img"):
-        if img.get("data-src") and not img.get("src"):
-            img["src"] = img["data-src"]
-        if "style" in img.attrs:
-            del img["style"]
-        if img.get("src"):
-            img["src"] = normalize_url(img["src"])
+def parse_episode_html(raw_html: str) -> Tuple[lxml_html.HtmlElement, List[Tuple[lxml_html.HtmlElement, str]]]:
+    """Parse episode HTML once and normalize its images in the same walk.
 
-    # Ensure document wrapper
-    if not soup.find("html"):
-        html_tag = soup.new_tag("html")
-        head = soup.new_tag("head")
-        meta = soup.new_tag("meta", charset="utf-8")
-        head.append(meta)
-        body = soup.new_tag("body")
-        for el in list(soup.children):
-            body.append(el.extract())
-        html_tag.append(head)
-        html_tag.append(body)
-        soup.append(html_tag)
+    Returns the fragment root and the (img element, absolute src) pairs so
+    callers can rewrite image sources later without walking the tree again.
+    """
+    root = _episode_root(raw_html)
+    imgs: List[Tuple[lxml_html.HtmlElement, str]] = []
 
-    return str(soup)
+    for img in root.iter("img"):
+        attrs = img.attrib
+        if attrs.get("data-src") and not attrs.get("src"):
+            attrs["src"] = attrs["data-src"]
+        if "style" in attrs:
+            del attrs["style"]
+        if attrs.get("src"):
+            src = normalize_url(attrs["src"])
+            attrs["src"] = src
+            imgs.append((img, src))
+
+    return root, imgs
+
+def fragment_xhtml(root: lxml_html.HtmlElement) -> str:
+    """Serialize the children of a fragment root as well-formed XHTML, without the wrapper."""
+    # one serialization pass over the whole fragment, then slice off the bare <div> wrapper
+    out = etree.tostring(root, encoding="unicode", method="xml")
+    return out[5:-6] if out.endswith("</div>") else ""
+
+def episode_text(raw_html: str) -> str:
+    """Plain text of an episode, one text node per line (scripts and styles dropped)."""
+    root = _episode_root(raw_html)
+    etree.strip_elements(root, "script", "style", with_tail=False)
+    return "\n".join(root.itertext())
 
 def fetch_novel_and_episodes(client, novel_id, start_chapter=None, end_chapter=None, max_chapters=None):
     # Auth check
@@ -58,13 +73,20 @@ def fetch_novel_and_episodes(client, novel_id, start_chapter=None, end_chapter=N
     data_list = client.episode_list(novel_id, rows=rows)
     ep_list = data_list["result"].get("list", [])
 
-    # Handle range
-    if start_chapter:
-        ep_list = [ep for ep in ep_list if int(ep.get("epi_num", 0)) >= int(start_chapter)]
-    if end_chapter:
-        ep_list = [ep for ep in ep_list if int(ep.get("epi_num", 0)) <= int(end_chapter)]
-
-    if max_chapters:
-        ep_list = ep_list[:int(max_chapters)]
+    # Handle range in one pass, stopping as soon as max_chapters are collected
+    cap = int(max_chapters) if max_chapters else None
+    if start_chapter or end_chapter:
+        lo = int(start_chapter) if start_chapter else None
+        hi = int(end_chapter) if end_chapter else None
+        selected = []
+        for ep in ep_list:
+            if cap is not None and len(selected) >= cap:
+                break
+            num = int(ep.get("epi_num") or 0)
+            if (lo is None or num >= lo) and (hi is None or num <= hi):
+                selected.append(ep)
+        ep_list = selected
+    elif cap is not None:
+        ep_list = ep_list[:cap]
 
     return data_novel, ep_list, title